@@ -3,15 +3,21 @@ import mediapipe as mp
 import numpy as np
 from PIL import Image
 
+from app.config import Config
+
 
 class FaceDetector:
     """Detects faces and facial landmarks using MediaPipe."""
 
+    # Maximum dimension fed to MediaPipe; landmarks are normalized so
+    # results are scaled back to the original image size
+    MAX_INFERENCE_DIMENSION = 1024
+
     def __init__(self):
         self.mp_face_mesh = mp.solutions.face_mesh
         self.face_mesh = self.mp_face_mesh.FaceMesh(
             static_image_mode=True,
-            max_num_faces=5,
+            max_num_faces=Config.MAX_FACES,
             min_detection_confidence=0.5
         )
 
@@ -25,8 +31,26 @@ class FaceDetector:
         Returns:
             List of face dictionaries with landmarks and bounding boxes
         """
-        # Convert PIL image to numpy array (RGB)
-        image_np = np.array(image)
+        img_width, img_height = image.size
+
+        # MediaPipe expects RGB
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        # Downscale before inference - MediaPipe runs its models at a few
+        # hundred pixels internally, so feeding full resolution just wastes
+        # CPU. Landmarks are normalized, so coordinates scale back for free.
+        scale = min(1.0, self.MAX_INFERENCE_DIMENSION / max(img_width, img_height))
+        if scale < 1.0:
+            # Clamp so extreme aspect ratios (e.g. 4000x3) don't truncate
+            # the short side to zero, which resize() rejects
+            image = image.resize(
+                (max(1, int(img_width * scale)), max(1, int(img_height * scale))),
+                Image.Resampling.BILINEAR
+            )
+
+        # Convert PIL image to a numpy view without copying the pixel buffer
+        image_np = np.asarray(image)
 
         # Process the image
         results = self.face_mesh.process(image_np)
@@ -34,85 +58,79 @@ class FaceDetector:
         if not results.multi_face_landmarks:
             return []
 
-        faces = []
-        img_height, img_width = image_np.shape[:2]
-
-        for face_landmarks in results.multi_face_landmarks:
-            # Get key landmarks for hat positioning
-            # Landmark indices (MediaPipe Face Mesh):
-            # 10: forehead center top
-            # 338: right forehead
-            # 109: left forehead
-            # 151: chin center
-            # 33: left eye outer corner
-            # 263: right eye outer corner
-
+        face_landmark_lists = results.multi_face_landmarks
+        num_faces = len(face_landmark_lists)
+
+        # Gather the key landmarks for all faces into one array, then
+        # compute every measurement with vectorized NumPy instead of
+        # per-face scalar math on protobuf attributes.
+        # Landmark indices (MediaPipe Face Mesh):
+        # 10: forehead center top
+        # 109: left forehead
+        # 338: right forehead
+        # 33: left eye outer corner
+        # 263: right eye outer corner
+        key_indices = (10, 109, 338, 33, 263)
+        points = np.empty((num_faces, len(key_indices), 2), dtype=np.float32)
+        for i, face_landmarks in enumerate(face_landmark_lists):
             landmarks = face_landmarks.landmark
+            for j, index in enumerate(key_indices):
+                landmark = landmarks[index]
+                points[i, j, 0] = landmark.x
+                points[i, j, 1] = landmark.y
+
+        # Convert normalized coordinates to pixel coordinates
+        points *= np.array([img_width, img_height], dtype=np.float32)
+
+        forehead_top = points[:, 0]
+        eye_left = points[:, 3]
+        eye_right = points[:, 4]
 
-            # Convert normalized coordinates to pixel coordinates
-            forehead_top = landmarks[10]
-            forehead_left = landmarks[109]
-            forehead_right = landmarks[338]
-            chin = landmarks[151]
-            left_eye = landmarks[33]
-            right_eye = landmarks[263]
-
-            # Calculate hat position and size
-            forehead_top_px = {
-                'x': forehead_top.x * img_width,
-                'y': forehead_top.y * img_height
-            }
-
-            forehead_left_px = {
-                'x': forehead_left.x * img_width,
-                'y': forehead_left.y * img_height
-            }
-
-            forehead_right_px = {
-                'x': forehead_right.x * img_width,
-                'y': forehead_right.y * img_height
-            }
-
-            # Calculate facial measurements for semantic positioning
-            eye_left_px = {'x': left_eye.x * img_width, 'y': left_eye.y * img_height}
-            eye_right_px = {'x': right_eye.x * img_width, 'y': right_eye.y * img_height}
-
-            # Eye distance (outer corners)
-            eye_distance = abs(eye_right_px['x'] - eye_left_px['x'])
-
-            # Eye midpoint (for horizontal centering)
-            eye_midpoint = {
-                'x': (eye_left_px['x'] + eye_right_px['x']) / 2,
-                'y': (eye_left_px['y'] + eye_right_px['y']) / 2
-            }
-
-            # Forehead width
-            forehead_width = abs(forehead_right_px['x'] - forehead_left_px['x'])
-
-            # Calculate head tilt angle
-            dx = eye_right_px['x'] - eye_left_px['x']
-            dy = eye_right_px['y'] - eye_left_px['y']
-            angle = np.degrees(np.arctan2(dy, dx))
+        # Eye distance (outer corners) and head tilt angle
+        eye_delta = eye_right - eye_left
+        eye_distance = np.abs(eye_delta[:, 0])
+        angle = np.degrees(np.arctan2(eye_delta[:, 1], eye_delta[:, 0]))
 
+        # Eye midpoint (for horizontal centering)
+        eye_midpoint = (eye_left + eye_right) / 2
+
+        # Forehead width
+        forehead_width = np.abs(points[:, 2, 0] - points[:, 1, 0])
+
+        faces = []
+        for i, face_landmarks in enumerate(face_landmark_lists):
             faces.append({
                 # Reference points
-                'forehead_top': forehead_top_px,
-                'eye_midpoint': eye_midpoint,
+                'forehead_top': {'x': float(forehead_top[i, 0]),
+                                 'y': float(forehead_top[i, 1])},
+                'eye_midpoint': {'x': float(eye_midpoint[i, 0]),
+                                 'y': float(eye_midpoint[i, 1])},
 
                 # Measurements
-                'eye_distance': eye_distance,
-                'forehead_width': forehead_width,
-                'angle': angle,
+                'eye_distance': float(eye_distance[i]),
+                'forehead_width': float(forehead_width[i]),
+                'angle': float(angle[i]),
 
                 # Legacy (for backwards compatibility)
-                'head_width': eye_distance * 2.0,
-                'all_landmarks': [(lm.x * img_width, lm.y * img_height)
-                                 for lm in landmarks]
+                'head_width': float(eye_distance[i]) * 2.0,
+                'all_landmarks': self._landmarks_to_pixels(
+                    face_landmarks.landmark, img_width, img_height)
             })
 
         return faces
 
-    def __del__(self):
-        """Cleanup MediaPipe resources."""
-        if hasattr(self, 'face_mesh'):
-            self.face_mesh.close()
+    @staticmethod
+    def _landmarks_to_pixels(landmarks, img_width: int, img_height: int) -> np.ndarray:
+        """
+        Convert normalized landmarks to an (N, 2) array of pixel coordinates.
+
+        Vectorized with NumPy rather than building 468 tuples per face in
+        a Python loop.
+        """
+        coords = np.fromiter(
+            (v for lm in landmarks for v in (lm.x, lm.y)),
+            dtype=np.float32,
+            count=len(landmarks) * 2
+        ).reshape(-1, 2)
+        coords *= np.array([img_width, img_height], dtype=np.float32)
+        return coords
@@ -1,13 +1,36 @@
 """Image processing module for adding Santa hats to photos."""
 from PIL import Image
-import os
+import math
+import numpy as np
 import json
+from collections import OrderedDict
 from pathlib import Path
 
 
 class SantaHatProcessor:
     """Handles Santa hat overlay on images."""
 
+    # Sprite cache bucketing: widths snap to 4px, angles to 2 degrees
+    # (visually imperceptible, gives near-perfect cache reuse)
+    SPRITE_WIDTH_BUCKET_PX = 4
+    SPRITE_ANGLE_BUCKET_DEG = 2
+    SPRITE_CACHE_SIZE = 256
+
+    # Hat sprites are rarely wider than a few hundred pixels, so a large
+    # source image is downscaled once at load time rather than paying for
+    # high-resolution resampling on every request
+    MAX_SOURCE_WIDTH = 512
+
+    # Default semantic positioning configuration
+    _DEFAULT_POSITIONING = {
+        'width_reference': 'eye_distance',
+        'width_multiplier': 2.0,
+        'hat_anchor_point': {'x': 0.5, 'y': 0.95},
+        'horizontal_center': 'midpoint_between_eyes',
+        'vertical_anchor': 'forehead_top',
+        'vertical_offset_px': 30
+    }
+
     def __init__(self, hat_image_path: str = None):
         """
         Initialize the processor with a Santa hat image.
@@ -20,103 +43,103 @@ class SantaHatProcessor:
             base_dir = Path(__file__).parent.parent
             hat_image_path = base_dir / "static" / "santa_hat.png"
 
-        if not os.path.exists(hat_image_path):
+        try:
+            self.hat_image = Image.open(hat_image_path).convert("RGBA")
+        except FileNotFoundError:
             raise FileNotFoundError(
                 f"Santa hat image not found at {hat_image_path}. "
                 "Please provide a santa_hat.png file."
             )
 
-        self.hat_image = Image.open(hat_image_path).convert("RGBA")
+        # Downscale an oversized source hat once; per-request transforms
+        # then resample from the smaller image
+        if self.hat_image.width > self.MAX_SOURCE_WIDTH:
+            source_aspect = self.hat_image.height / self.hat_image.width
+            self.hat_image = self.hat_image.resize(
+                (self.MAX_SOURCE_WIDTH, int(self.MAX_SOURCE_WIDTH * source_aspect)),
+                Image.Resampling.LANCZOS
+            )
+
+        # LRU cache of scaled+rotated hat sprites keyed on (width, angle)
+        self._sprite_cache: OrderedDict[tuple[int, int], Image.Image] = OrderedDict()
 
         # Load hat metadata (semantic positioning configuration)
         metadata_path = Path(hat_image_path).with_suffix('.json')
-        if os.path.exists(metadata_path):
+        try:
             with open(metadata_path, 'r') as f:
                 metadata = json.load(f)
-                self.positioning = metadata.get('positioning', self._default_positioning())
-        else:
+                self.positioning = metadata.get('positioning', dict(self._DEFAULT_POSITIONING))
+        except FileNotFoundError:
             # Default semantic positioning
-            self.positioning = self._default_positioning()
-
-    def _default_positioning(self):
-        """Return default semantic positioning configuration."""
-        return {
-            'width_reference': 'eye_distance',
-            'width_multiplier': 2.0,
-            'hat_anchor_point': {'x': 0.5, 'y': 0.95},
-            'horizontal_center': 'midpoint_between_eyes',
-            'vertical_anchor': 'forehead_top',
-            'vertical_offset_px': 30
-        }
+            self.positioning = dict(self._DEFAULT_POSITIONING)
+
+        # Resolve positioning lookups once instead of per face
+        self._aspect_ratio = self.hat_image.height / self.hat_image.width
+        self._width_reference = self.positioning.get('width_reference', 'eye_distance')
+        self._width_multiplier = self.positioning.get('width_multiplier', 2.0)
+        hat_anchor = self.positioning.get('hat_anchor_point', {'x': 0.5, 'y': 0.95})
+        self._hat_anchor_x = hat_anchor['x']
+        self._hat_anchor_y = hat_anchor['y']
+        self._horizontal_center = self.positioning.get('horizontal_center', 'midpoint_between_eyes')
+        self._vertical_anchor = self.positioning.get('vertical_anchor', 'forehead_top')
+        self._vertical_offset_px = self.positioning.get('vertical_offset_px', 0)
 
     def add_hat_to_face(
         self,
         image: Image.Image,
         face_data: dict,
-        hat_scale: float = 1.0
+        hat_scale: float = 1.0,
+        rotation: tuple[float, float, float] = None
     ) -> Image.Image:
         """
         Add a Santa hat to a single face using semantic positioning.
 
+        The hat is pasted directly onto the image in place, so only the
+        hat's bounding box is touched rather than the full canvas.
+
         Args:
-            image: Original image (will be converted to RGBA)
+            image: RGBA image to draw on (modified in place)
             face_data: Face detection data with facial measurements
             hat_scale: Optional scale multiplier (default 1.0, uses metadata multiplier)
+            rotation: Optional precomputed (angle, cos, sin) for the bucketed
+                head tilt; computed from face_data when omitted
 
         Returns:
-            Image with Santa hat added
+            The same image with the Santa hat added
         """
-        # Convert image to RGBA if needed
-        if image.mode != "RGBA":
-            image = image.convert("RGBA")
-
         # Get the reference measurement based on positioning config
-        width_ref = self.positioning['width_reference']
-        if width_ref == 'eye_distance':
-            reference_width = face_data['eye_distance']
-        elif width_ref == 'forehead_width':
+        if self._width_reference == 'forehead_width':
             reference_width = face_data['forehead_width']
         else:
             # Default to eye_distance
             reference_width = face_data['eye_distance']
 
         # Calculate hat width using semantic multiplier
-        hat_width = int(reference_width * self.positioning['width_multiplier'] * hat_scale)
-
-        # Maintain aspect ratio
-        aspect_ratio = self.hat_image.height / self.hat_image.width
-        hat_height = int(hat_width * aspect_ratio)
-
-        # Resize hat
-        resized_hat = self.hat_image.resize(
-            (hat_width, hat_height),
-            Image.Resampling.LANCZOS
-        )
+        hat_width = int(reference_width * self._width_multiplier * hat_scale)
 
-        # Rotate hat to match head angle
-        angle = face_data['angle']
-        rotated_hat = resized_hat.rotate(
-            -angle,  # Negative to match head tilt
-            expand=True,
-            resample=Image.Resampling.BICUBIC
+        # Bucket width and angle so faces with near-identical geometry
+        # share a cached sprite
+        hat_width = max(
+            self.SPRITE_WIDTH_BUCKET_PX,
+            hat_width // self.SPRITE_WIDTH_BUCKET_PX * self.SPRITE_WIDTH_BUCKET_PX
         )
+        if rotation is None:
+            rotation = self._face_rotation(face_data['angle'])
+        angle, cos_a, sin_a = rotation
 
-        # Get hat anchor point (which point on the hat should align with target)
-        hat_anchor = self.positioning.get('hat_anchor_point', {'x': 0.5, 'y': 0.95})
+        # Maintain aspect ratio
+        hat_height = int(hat_width * self._aspect_ratio)
 
-        # Calculate anchor point on the RESIZED hat (before rotation)
-        anchor_x_on_hat = resized_hat.width * hat_anchor['x']
-        anchor_y_on_hat = resized_hat.height * hat_anchor['y']
+        rotated_hat = self._get_hat_sprite(hat_width, hat_height, angle)
 
-        # Transform the anchor point through rotation
-        import math
-        rad = math.radians(-angle)
-        cos_a = math.cos(rad)
-        sin_a = math.sin(rad)
+        # Calculate anchor point on the scaled hat (before rotation) -
+        # this is the point on the hat that aligns with the target
+        anchor_x_on_hat = hat_width * self._hat_anchor_x
+        anchor_y_on_hat = hat_height * self._hat_anchor_y
 
-        # Anchor relative to center of resized hat
-        rel_x = anchor_x_on_hat - resized_hat.width / 2
-        rel_y = anchor_y_on_hat - resized_hat.height / 2
+        # Anchor relative to center of scaled hat
+        rel_x = anchor_x_on_hat - hat_width / 2
+        rel_y = anchor_y_on_hat - hat_height / 2
 
         # Rotate around origin
         rotated_rel_x = rel_x * cos_a - rel_y * sin_a
@@ -127,36 +150,85 @@ class SantaHatProcessor:
         rotated_anchor_y = rotated_rel_y + rotated_hat.height / 2
 
         # Get target position based on positioning config
-        horizontal_center = self.positioning.get('horizontal_center', 'midpoint_between_eyes')
-        if horizontal_center == 'midpoint_between_eyes':
-            target_x = face_data['eye_midpoint']['x']
-        elif horizontal_center == 'forehead_top':
+        if self._horizontal_center == 'forehead_top':
             target_x = face_data['forehead_top']['x']
         else:
             target_x = face_data['eye_midpoint']['x']
 
-        vertical_anchor = self.positioning.get('vertical_anchor', 'forehead_top')
-        if vertical_anchor == 'forehead_top':
-            target_y = face_data['forehead_top']['y']
-        else:
-            target_y = face_data['forehead_top']['y']
+        # Only forehead_top is supported as a vertical anchor today
+        target_y = face_data['forehead_top']['y']
 
         # Apply vertical offset
-        vertical_offset = self.positioning.get('vertical_offset_px', 0)
-        target_y += vertical_offset
+        target_y += self._vertical_offset_px
 
         # Position the hat so its rotated anchor point aligns with target
         hat_x = int(target_x - rotated_anchor_x)
         hat_y = int(target_y - rotated_anchor_y)
 
-        # Create a new transparent layer for the hat
-        hat_layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        hat_layer.paste(rotated_hat, (hat_x, hat_y), rotated_hat)
+        # Paste the hat directly onto the image (only touches the hat bbox,
+        # avoiding a full-frame composite per face)
+        image.paste(rotated_hat, (hat_x, hat_y), rotated_hat)
 
-        # Composite the hat onto the image
-        result = Image.alpha_composite(image, hat_layer)
+        return image
 
-        return result
+    @classmethod
+    def _face_rotation(cls, face_angle: float) -> tuple[float, float, float]:
+        """Return (bucketed angle, cos, sin) for a face's head tilt."""
+        angle = round(face_angle / cls.SPRITE_ANGLE_BUCKET_DEG) \
+            * cls.SPRITE_ANGLE_BUCKET_DEG
+        rad = math.radians(-angle)  # Negative to match head tilt
+        return angle, math.cos(rad), math.sin(rad)
+
+    def _get_hat_sprite(
+        self,
+        hat_width: int,
+        hat_height: int,
+        angle: float
+    ) -> Image.Image:
+        """
+        Return the hat scaled to (hat_width, hat_height) and rotated by angle.
+
+        Sprites are cached in an LRU keyed on (width, angle); callers bucket
+        their inputs so nearby faces and repeat requests hit the cache
+        instead of resampling the hat again.
+        """
+        cache_key = (hat_width, angle)
+        sprite = self._sprite_cache.get(cache_key)
+        if sprite is not None:
+            self._sprite_cache.move_to_end(cache_key)
+            return sprite
+
+        rad = math.radians(-angle)  # Negative to match head tilt
+        cos_a = math.cos(rad)
+        sin_a = math.sin(rad)
+
+        # Output canvas is the bounding box of the scaled, rotated hat
+        out_width = int(math.ceil(abs(hat_width * cos_a) + abs(hat_height * sin_a)))
+        out_height = int(math.ceil(abs(hat_width * sin_a) + abs(hat_height * cos_a)))
+
+        # Scale and rotate in a single affine transform (one resampling pass
+        # instead of a LANCZOS resize + BICUBIC rotate). PIL's AFFINE
+        # transform maps destination pixels back to source pixels: rotate
+        # around the output center, then undo the scale
+        scale_x = hat_width / self.hat_image.width
+        scale_y = hat_height / self.hat_image.height
+        sprite = self.hat_image.transform(
+            (out_width, out_height),
+            Image.Transform.AFFINE,
+            (
+                cos_a / scale_x, -sin_a / scale_x,
+                (hat_width / 2 - cos_a * out_width / 2 + sin_a * out_height / 2) / scale_x,
+                sin_a / scale_y, cos_a / scale_y,
+                (hat_height / 2 - sin_a * out_width / 2 - cos_a * out_height / 2) / scale_y,
+            ),
+            resample=Image.Resampling.BILINEAR
+        )
+
+        self._sprite_cache[cache_key] = sprite
+        if len(self._sprite_cache) > self.SPRITE_CACHE_SIZE:
+            self._sprite_cache.popitem(last=False)
+
+        return sprite
 
     def process_image(
         self,
@@ -179,11 +251,24 @@ class SantaHatProcessor:
             # No faces detected, return original
             return image
 
-        # Convert to RGBA for transparency
+        # Convert to RGBA once; each hat is then pasted in place
         result = image.convert("RGBA")
 
+        # Batch the rotation trig for all faces in one vectorized pass,
+        # bucketing angles to the sprite grid as _face_rotation does
+        angles = np.round(
+            np.array([face['angle'] for face in faces], dtype=np.float64)
+            / self.SPRITE_ANGLE_BUCKET_DEG
+        ) * self.SPRITE_ANGLE_BUCKET_DEG
+        rads = np.deg2rad(-angles)  # Negative to match head tilt
+        cos_values = np.cos(rads)
+        sin_values = np.sin(rads)
+
         # Add hat to each face
-        for face in faces:
-            result = self.add_hat_to_face(result, face, hat_scale)
+        for face, angle, cos_a, sin_a in zip(faces, angles, cos_values, sin_values):
+            self.add_hat_to_face(
+                result, face, hat_scale,
+                rotation=(float(angle), float(cos_a), float(sin_a))
+            )
 
         return result
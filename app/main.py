@@ -1,14 +1,19 @@
 """Santa Hat API - Add Santa hats to photos using face detection."""
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
-from fastapi.responses import StreamingResponse
-from PIL import Image
+from fastapi.responses import Response, StreamingResponse
+from PIL import features
+import asyncio
 import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import formatdate
+from urllib.parse import urljoin, urlsplit
 from typing import Optional
 import httpx
 from pydantic import BaseModel, HttpUrl, Field
 
-from app.face_detection import FaceDetector
 from app.image_processing import SantaHatProcessor
+from app.pipeline import PipelineError, process_image_bytes
 from app.s3_cache import S3Cache
 from app.config import Config
 
@@ -25,8 +30,15 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Initialize face detector, hat processor, and S3 cache (singleton pattern)
-face_detector = FaceDetector()
+# JPEG encode/decode dominates request CPU after inference; surface a
+# misbuilt Pillow (stock libjpeg instead of libjpeg-turbo) at startup
+if features.check_feature('libjpeg_turbo'):
+    print("Pillow is linked against libjpeg-turbo (SIMD JPEG codec)")
+else:
+    print("Warning: Pillow is NOT linked against libjpeg-turbo; JPEG encode/decode will be slow")
+
+# Initialize hat processor and S3 cache (singleton pattern). Face
+# detection runs inside pool workers, which hold their own detectors.
 try:
     hat_processor = SantaHatProcessor()
 except FileNotFoundError as e:
@@ -37,6 +49,97 @@ except FileNotFoundError as e:
 # Initialize S3 cache
 s3_cache = S3Cache()
 
+# Shared HTTP client - reuses pooled connections and TLS sessions across
+# requests instead of handshaking per fetch. Redirects are followed
+# manually in process_from_url so every hop passes SSRF validation;
+# auto-following would fetch whatever an attacker-controlled redirect
+# points at, bypassing the host checks entirely.
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(Config.URL_FETCH_TIMEOUT_SECONDS),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+)
+
+# Redirect hops followed per fetch before giving up
+MAX_REDIRECTS = 5
+
+
+# Responses up to this size are returned as plain bytes; larger payloads
+# fall back to the streaming machinery
+LARGE_RESPONSE_THRESHOLD_BYTES = 8 * 1024 * 1024
+
+# How long clients and CDNs may reuse a rendered response; the cache key
+# doubles as the ETag so revalidation is a hash comparison
+CLIENT_CACHE_MAX_AGE_SECONDS = 86400
+
+
+def filename_from_url(url: str) -> str:
+    """Extract a display filename from a URL path, ignoring the query."""
+    return urlsplit(url).path.rsplit("/", 1)[-1] or "image.jpg"
+
+
+def response_headers(filename: str, extra_headers: dict, cache_key: str = None) -> dict:
+    """Build response headers, adding client-cache validators when keyed."""
+    headers = {"Content-Disposition": f"inline; filename=santa_{filename}"}
+    if cache_key:
+        headers["ETag"] = f'"{cache_key}"'
+        headers["Cache-Control"] = f"public, max-age={CLIENT_CACHE_MAX_AGE_SECONDS}"
+        headers["Last-Modified"] = formatdate(usegmt=True)
+    headers.update(extra_headers)
+    return headers
+
+
+def not_modified_response(request: Request, cache_key: str) -> Optional[Response]:
+    """Return a 304 when the client's If-None-Match matches our cache key."""
+    if request.headers.get("if-none-match") == f'"{cache_key}"':
+        return Response(status_code=304, headers={
+            "ETag": f'"{cache_key}"',
+            "Cache-Control": f"public, max-age={CLIENT_CACHE_MAX_AGE_SECONDS}"
+        })
+    return None
+
+
+def image_response(
+    img_bytes: bytes,
+    filename: str,
+    extra_headers: dict,
+    cache_key: str = None
+) -> Response:
+    """Build a JPEG response, skipping chunked streaming for typical sizes."""
+    headers = response_headers(filename, extra_headers, cache_key)
+    if len(img_bytes) > LARGE_RESPONSE_THRESHOLD_BYTES:
+        return StreamingResponse(
+            io.BytesIO(img_bytes),
+            media_type="image/jpeg",
+            headers=headers
+        )
+    return Response(content=img_bytes, media_type="image/jpeg", headers=headers)
+
+
+def cached_stream_response(
+    body,
+    filename: str,
+    extra_headers: dict,
+    cache_key: str = None
+) -> StreamingResponse:
+    """Pipe a cached S3 object body to the client without buffering it."""
+    return StreamingResponse(
+        body.iter_chunks(64 * 1024),
+        media_type="image/jpeg",
+        headers=response_headers(filename, extra_headers, cache_key)
+    )
+
+
+# Process pool for the CPU-heavy pipeline (decode, MediaPipe inference,
+# compositing, JPEG encode) so large images don't block the event loop
+process_executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+@app.on_event("shutdown")
+async def shutdown_resources():
+    """Close the shared HTTP client pool and the worker process pool."""
+    await http_client.aclose()
+    process_executor.shutdown(wait=False, cancel_futures=True)
+
 
 @app.get("/")
 async def root():
@@ -63,8 +166,223 @@ async def health_check():
     }
 
 
+async def render_image(contents: bytes, hat_scale: float) -> tuple[bytes, int]:
+    """
+    Run the CPU-heavy pipeline (decode, detect, composite, encode) in the
+    process pool so it doesn't block the event loop.
+    """
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            process_executor, process_image_bytes, contents, hat_scale
+        )
+    except PipelineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+
+# Single-flight: renders in progress, keyed by cache key, so a thundering
+# herd on one cold image occupies one pool worker instead of N
+_inflight_renders: dict[str, asyncio.Future] = {}
+
+
+async def render_image_once(
+    cache_key: str,
+    contents: bytes,
+    hat_scale: float
+) -> tuple[bytes, int]:
+    """
+    Render through the process pool, coalescing concurrent identical work.
+
+    The first caller for a key runs the pipeline; concurrent callers for
+    the same key await its result instead of dispatching their own render.
+    """
+    existing = _inflight_renders.get(cache_key)
+    if existing is not None:
+        return await asyncio.shield(existing)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight_renders[cache_key] = future
+    try:
+        result = await render_image(contents, hat_scale)
+    except BaseException as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved if nobody piggybacked
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _inflight_renders.pop(cache_key, None)
+
+
+async def process_from_url(request: Request, url: str, hat_scale: float) -> Response:
+    """
+    Shared pipeline for URL inputs (GET endpoint and the POST URL branch).
+
+    Checks the client's ETag, looks up the URL-keyed cache entry and
+    revalidates it against the upstream with a conditional GET, streams
+    the fetch with a size cap, short-circuits on a content-hash cache
+    hit, renders in the process pool, and stores the result under both
+    the URL key and the content-hash key.
+    """
+    # A client revalidating with our own ETag skips S3 entirely
+    cache_key = s3_cache.generate_cache_key_from_url(url, hat_scale)
+    not_modified = not_modified_response(request, cache_key)
+    if not_modified:
+        return not_modified
+
+    cached = await s3_cache.open_cached_image(cache_key)
+    cached_body, cached_metadata = cached if cached else (None, {})
+
+    filename = filename_from_url(url)
+
+    # Revalidate a cached render with a single conditional GET using
+    # the upstream validators stored alongside it; with no validators
+    # the cached object is streamed straight through without ever
+    # materializing in this process
+    conditional_headers = {}
+    cached_image = None
+    if cached_body is not None:
+        if cached_metadata.get("upstream_etag"):
+            conditional_headers["If-None-Match"] = cached_metadata["upstream_etag"]
+        if cached_metadata.get("upstream_last_modified"):
+            conditional_headers["If-Modified-Since"] = cached_metadata["upstream_last_modified"]
+        if not conditional_headers:
+            print(f"Cache HIT: {cache_key}")
+            return cached_stream_response(cached_body, filename,
+                                          {"X-Cache-Status": "HIT"}, cache_key)
+        # Revalidation may still need the bytes (to serve on 304)
+        cached_image = await asyncio.to_thread(cached_body.read)
+
+    print(f"Cache {'REVALIDATE' if cached_image else 'MISS'}: {cache_key}")
+
+    # Fetch image from URL, streaming with an early size cap
+    upstream_etag = ""
+    upstream_last_modified = ""
+    try:
+        fetch_url = url
+        for _ in range(MAX_REDIRECTS + 1):
+            async with http_client.stream(
+                "GET", fetch_url, headers=conditional_headers
+            ) as response:
+                # Redirect targets are server-controlled, so each hop is
+                # validated against the SSRF rules before it is fetched.
+                # (is_redirect is true for any 3xx, including the 304
+                # revalidation answer handled below, so check for an
+                # actual redirect with a Location instead.)
+                if response.has_redirect_location:
+                    fetch_url = urljoin(fetch_url, response.headers["location"])
+                    is_valid, error_msg = await Config.validate_url_safety(fetch_url)
+                    if not is_valid:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Invalid redirect URL: {error_msg}"
+                        )
+                    continue
+
+                # Upstream unchanged - serve the cached render without
+                # downloading or processing anything
+                if response.status_code == 304 and cached_image is not None:
+                    return image_response(cached_image, filename,
+                                          {"X-Cache-Status": "REVALIDATED"}, cache_key)
+
+                response.raise_for_status()
+
+                # Remember the upstream validators for future revalidation
+                upstream_etag = response.headers.get("etag", "")
+                upstream_last_modified = response.headers.get("last-modified", "")
+
+                # Validate content type
+                content_type = response.headers.get("content-type", "")
+                if content_type not in Config.ALLOWED_IMAGE_TYPES:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Unsupported image type: {content_type}. Allowed types: {', '.join(Config.ALLOWED_IMAGE_TYPES)}"
+                    )
+
+                # Stream the body, aborting as soon as the cap is exceeded.
+                # The measured byte count is the only size check - it also
+                # covers chunked transfers and servers that lie about
+                # Content-Length. The content hash is folded into the same
+                # pass so the buffer isn't traversed again for the key.
+                buffer = bytearray()
+                hasher = s3_cache.content_hasher()
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    buffer += chunk
+                    hasher.update(chunk)
+                    if len(buffer) > Config.MAX_FILE_SIZE_BYTES:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Image too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
+                        )
+                contents = bytes(buffer)
+                break
+        else:
+            raise HTTPException(
+                status_code=400,
+                detail="Failed to fetch image from URL: too many redirects"
+            )
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Failed to fetch image from URL: HTTP {e.response.status_code}"
+        )
+    except httpx.RequestError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Failed to fetch image from URL: {str(e)}"
+        )
+
+    # Identical bytes hosted at different URLs collapse to a single
+    # render via the content-hash cache
+    content_key = s3_cache.generate_cache_key_from_hasher(hasher, hat_scale)
+    cached_render = await s3_cache.open_cached_image(content_key)
+    if cached_render:
+        print(f"Cache HIT (content): {content_key}")
+        render_body, render_metadata = cached_render
+        img_bytes = await asyncio.to_thread(render_body.read)
+        # Refresh the URL-key entry with the validators just observed;
+        # otherwise it keeps the stale ones and every future request
+        # for this URL fails revalidation and re-downloads the body
+        await s3_cache.store_cached_image(
+            cache_key,
+            img_bytes,
+            metadata={
+                "faces_detected": render_metadata.get("faces_detected", ""),
+                "upstream_etag": upstream_etag,
+                "upstream_last_modified": upstream_last_modified
+            }
+        )
+        return image_response(img_bytes, filename,
+                              {"X-Cache-Status": "HIT"}, cache_key)
+
+    img_bytes, faces_detected = await render_image_once(content_key, contents, hat_scale)
+
+    # Store under the URL key (with upstream validators) and the
+    # content-hash key
+    await s3_cache.store_cached_image(
+        cache_key,
+        img_bytes,
+        metadata={
+            "faces_detected": faces_detected,
+            "upstream_etag": upstream_etag,
+            "upstream_last_modified": upstream_last_modified
+        }
+    )
+    await s3_cache.store_cached_image(
+        content_key,
+        img_bytes,
+        metadata={"faces_detected": faces_detected}
+    )
+
+    return image_response(img_bytes, filename, {
+        "X-Faces-Detected": str(faces_detected),
+        "X-Cache-Status": "MISS"
+    }, cache_key)
+
+
 @app.get("/santa-hatify")
 async def santa_hatify_get(
+    request: Request,
     url: str,
     hat_scale: float = 1.0
 ):
@@ -95,7 +413,7 @@ async def santa_hatify_get(
         )
 
     # Validate URL safety (prevent SSRF attacks)
-    is_valid, error_msg = Config.validate_url_safety(url)
+    is_valid, error_msg = await Config.validate_url_safety(url)
     if not is_valid:
         raise HTTPException(
             status_code=400,
@@ -103,151 +421,7 @@ async def santa_hatify_get(
         )
 
     try:
-        # Generate cache key and check cache
-        cache_key = await s3_cache.generate_cache_key_from_url(url, hat_scale)
-        cached_image = None
-
-        if cache_key:
-            cached_image = await s3_cache.get_cached_image(cache_key)
-
-        # If cache hit, return immediately
-        if cached_image:
-            print(f"Cache HIT: {cache_key}")
-            filename = url.split("/")[-1].split("?")[0] or "cached_image.jpg"
-            return StreamingResponse(
-                io.BytesIO(cached_image),
-                media_type="image/jpeg",
-                headers={
-                    "Content-Disposition": f"inline; filename=santa_{filename}",
-                    "X-Cache-Status": "HIT"
-                }
-            )
-
-        print(f"Cache MISS: {cache_key or 'no cache key'}")
-
-        # Fetch image from URL
-        async with httpx.AsyncClient(timeout=Config.URL_FETCH_TIMEOUT_SECONDS) as client:
-            try:
-                response = await client.get(url)
-                response.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Failed to fetch image from URL: HTTP {e.response.status_code}"
-                )
-            except httpx.RequestError as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Failed to fetch image from URL: {str(e)}"
-                )
-
-            # Validate content type
-            content_type = response.headers.get("content-type", "")
-            if content_type not in Config.ALLOWED_IMAGE_TYPES:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Unsupported image type: {content_type}. Allowed types: {', '.join(Config.ALLOWED_IMAGE_TYPES)}"
-                )
-
-            # Check content length
-            content_length = response.headers.get("content-length")
-            if content_length and int(content_length) > Config.MAX_FILE_SIZE_BYTES:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Image too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
-                )
-
-            contents = response.content
-
-            # Double-check actual size
-            if len(contents) > Config.MAX_FILE_SIZE_BYTES:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Image too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
-                )
-
-            filename = url.split("/")[-1].split("?")[0] or "image.jpg"
-
-        # Read and open image
-        image = Image.open(io.BytesIO(contents))
-
-        # Validate image format
-        if image.format not in Config.ALLOWED_PIL_FORMATS:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Unsupported image format: {image.format}. Allowed formats: {', '.join(Config.ALLOWED_PIL_FORMATS)}"
-            )
-
-        # Validate image dimensions
-        width, height = image.size
-        if width > Config.MAX_IMAGE_WIDTH or height > Config.MAX_IMAGE_HEIGHT:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Image dimensions too large. Maximum: {Config.MAX_IMAGE_WIDTH}x{Config.MAX_IMAGE_HEIGHT}px, got: {width}x{height}px"
-            )
-
-        # Validate total pixels
-        total_pixels = width * height
-        if total_pixels > Config.MAX_IMAGE_PIXELS:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Image has too many pixels. Maximum: {Config.MAX_IMAGE_PIXELS}, got: {total_pixels}"
-            )
-
-        # Convert to RGB if necessary
-        if image.mode not in ('RGB', 'RGBA'):
-            image = image.convert('RGB')
-
-        # Detect faces
-        faces = face_detector.detect_faces(image)
-
-        if not faces:
-            raise HTTPException(
-                status_code=404,
-                detail="No faces detected in the image. Please upload an image with visible faces."
-            )
-
-        # Limit number of faces processed
-        if len(faces) > Config.MAX_FACES:
-            faces = faces[:Config.MAX_FACES]
-            print(f"Warning: Image has more than {Config.MAX_FACES} faces, limiting to {Config.MAX_FACES}")
-
-        # Process image with Santa hats
-        result_image = hat_processor.process_image(image, faces, hat_scale)
-
-        # Convert back to RGB for JPEG output
-        if result_image.mode == 'RGBA':
-            rgb_image = Image.new('RGB', result_image.size, (255, 255, 255))
-            rgb_image.paste(result_image, mask=result_image.split()[3])
-            result_image = rgb_image
-
-        # Save to bytes buffer
-        img_buffer = io.BytesIO()
-        result_image.save(img_buffer, format='JPEG', quality=95)
-        img_buffer.seek(0)
-        img_bytes = img_buffer.getvalue()
-
-        # Store in cache
-        if cache_key:
-            await s3_cache.store_cached_image(
-                cache_key,
-                img_bytes,
-                metadata={"faces_detected": len(faces)}
-            )
-
-        # Reset buffer for response
-        img_buffer.seek(0)
-
-        return StreamingResponse(
-            img_buffer,
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"inline; filename=santa_{filename}",
-                "X-Faces-Detected": str(len(faces)),
-                "X-Cache-Status": "MISS"
-            }
-        )
-
+        return await process_from_url(request, url, hat_scale)
     except HTTPException:
         raise
     except Exception as e:
@@ -326,202 +500,88 @@ async def santa_hatify(
             detail="hat_scale must be between 0 and 5"
         )
 
-    # Validate URL safety if URL is provided
+    # URL inputs share the full pipeline with the GET endpoint
     if url is not None:
-        is_valid, error_msg = Config.validate_url_safety(url)
+        is_valid, error_msg = await Config.validate_url_safety(url)
         if not is_valid:
             raise HTTPException(
                 status_code=400,
                 detail=f"Invalid URL: {error_msg}"
             )
 
-    try:
-        # Generate cache key and check cache before processing
-        cache_key = None
-        cached_image = None
-
-        if url is not None:
-            # For URLs, use ETag/Last-Modified based cache key
-            cache_key = await s3_cache.generate_cache_key_from_url(url, hat_scale)
-            if cache_key:
-                cached_image = await s3_cache.get_cached_image(cache_key)
-
-        # If cache hit, return cached result immediately
-        if cached_image:
-            print(f"Cache HIT: {cache_key}")
-            filename = url.split("/")[-1].split("?")[0] if url else "cached_image.jpg"
-            return StreamingResponse(
-                io.BytesIO(cached_image),
-                media_type="image/jpeg",
-                headers={
-                    "Content-Disposition": f"inline; filename=santa_{filename}",
-                    "X-Cache-Status": "HIT"
-                }
-            )
-
-        print(f"Cache MISS: {cache_key or 'no cache key'}")
-
-        # Get image data from either file upload or URL
-        if file is not None:
-            # Validate file type
-            if file.content_type not in Config.ALLOWED_IMAGE_TYPES:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Unsupported image type: {file.content_type}. Allowed types: {', '.join(Config.ALLOWED_IMAGE_TYPES)}"
-                )
-
-            contents = await file.read()
-
-            # Validate file size
-            if len(contents) > Config.MAX_FILE_SIZE_BYTES:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"File too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
-                )
-
-            filename = file.filename
-
-            # Generate cache key from file hash
-            cache_key = s3_cache.generate_cache_key_from_hash(contents, hat_scale)
-            cached_image = await s3_cache.get_cached_image(cache_key)
-
-            # If cache hit, return cached result
-            if cached_image:
-                print(f"Cache HIT: {cache_key}")
-                return StreamingResponse(
-                    io.BytesIO(cached_image),
-                    media_type="image/jpeg",
-                    headers={
-                        "Content-Disposition": f"inline; filename=santa_{filename}",
-                        "X-Cache-Status": "HIT"
-                    }
-                )
-        else:
-            # Fetch image from URL
-            async with httpx.AsyncClient(timeout=Config.URL_FETCH_TIMEOUT_SECONDS) as client:
-                try:
-                    response = await client.get(url)
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Failed to fetch image from URL: HTTP {e.response.status_code}"
-                    )
-                except httpx.RequestError as e:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Failed to fetch image from URL: {str(e)}"
-                    )
-
-                # Validate content type
-                content_type = response.headers.get("content-type", "")
-                if content_type not in Config.ALLOWED_IMAGE_TYPES:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Unsupported image type: {content_type}. Allowed types: {', '.join(Config.ALLOWED_IMAGE_TYPES)}"
-                    )
-
-                # Check content length
-                content_length = response.headers.get("content-length")
-                if content_length and int(content_length) > Config.MAX_FILE_SIZE_BYTES:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Image too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
-                    )
-
-                contents = response.content
-
-                # Double-check actual size
-                if len(contents) > Config.MAX_FILE_SIZE_BYTES:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Image too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
-                    )
-
-                # Extract filename from URL or use default
-                filename = url.split("/")[-1].split("?")[0] or "image.jpg"
-
-        # Read and open image
-        image = Image.open(io.BytesIO(contents))
-
-        # Validate image format
-        if image.format not in Config.ALLOWED_PIL_FORMATS:
+        try:
+            return await process_from_url(request, url, hat_scale)
+        except HTTPException:
+            raise
+        except Exception as e:
             raise HTTPException(
-                status_code=400,
-                detail=f"Unsupported image format: {image.format}. Allowed formats: {', '.join(Config.ALLOWED_PIL_FORMATS)}"
+                status_code=500,
+                detail=f"Error processing image: {str(e)}"
             )
 
-        # Validate image dimensions
-        width, height = image.size
-        if width > Config.MAX_IMAGE_WIDTH or height > Config.MAX_IMAGE_HEIGHT:
+    try:
+        # Validate file type
+        if file.content_type not in Config.ALLOWED_IMAGE_TYPES:
             raise HTTPException(
                 status_code=400,
-                detail=f"Image dimensions too large. Maximum: {Config.MAX_IMAGE_WIDTH}x{Config.MAX_IMAGE_HEIGHT}px, got: {width}x{height}px"
+                detail=f"Unsupported image type: {file.content_type}. Allowed types: {', '.join(Config.ALLOWED_IMAGE_TYPES)}"
             )
 
-        # Validate total pixels
-        total_pixels = width * height
-        if total_pixels > Config.MAX_IMAGE_PIXELS:
+        # Reject on the declared size before reading anything
+        if file.size is not None and file.size > Config.MAX_FILE_SIZE_BYTES:
             raise HTTPException(
                 status_code=400,
-                detail=f"Image has too many pixels. Maximum: {Config.MAX_IMAGE_PIXELS}, got: {total_pixels}"
+                detail=f"File too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
             )
 
-        # Convert to RGB if necessary (handle RGBA, grayscale, etc.)
-        if image.mode not in ('RGB', 'RGBA'):
-            image = image.convert('RGB')
+        # Read in chunks, aborting as soon as the size cap is exceeded;
+        # the content hash is folded into the same pass
+        buffer = bytearray()
+        hasher = s3_cache.content_hasher()
+        while chunk := await file.read(64 * 1024):
+            buffer += chunk
+            hasher.update(chunk)
+            if len(buffer) > Config.MAX_FILE_SIZE_BYTES:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"File too large. Maximum size: {Config.MAX_FILE_SIZE_MB}MB"
+                )
+        contents = bytes(buffer)
+
+        filename = file.filename
 
-        # Detect faces
-        faces = face_detector.detect_faces(image)
+        # The cache key comes from the hash folded into the read loop
+        # above - never from client-supplied headers, which would let a
+        # forged digest read or poison another upload's cache entry. A
+        # client revalidating with our own ETag skips S3 entirely.
+        cache_key = s3_cache.generate_cache_key_from_hasher(hasher, hat_scale)
+        not_modified = not_modified_response(request, cache_key)
+        if not_modified:
+            return not_modified
 
-        if not faces:
-            raise HTTPException(
-                status_code=404,
-                detail="No faces detected in the image. Please upload an image with visible faces."
-            )
+        cached = await s3_cache.open_cached_image(cache_key)
 
-        # Limit number of faces processed
-        if len(faces) > Config.MAX_FACES:
-            faces = faces[:Config.MAX_FACES]
-            print(f"Warning: Image has more than {Config.MAX_FACES} faces, limiting to {Config.MAX_FACES}")
-
-        # Process image with Santa hats
-        result_image = hat_processor.process_image(image, faces, hat_scale)
-
-        # Convert back to RGB for JPEG output (remove alpha channel)
-        if result_image.mode == 'RGBA':
-            # Create white background
-            rgb_image = Image.new('RGB', result_image.size, (255, 255, 255))
-            rgb_image.paste(result_image, mask=result_image.split()[3])  # Use alpha as mask
-            result_image = rgb_image
-
-        # Save to bytes buffer
-        img_buffer = io.BytesIO()
-        result_image.save(img_buffer, format='JPEG', quality=95)
-        img_buffer.seek(0)
-        img_bytes = img_buffer.getvalue()
-
-        # Store in cache if we have a cache key
-        if cache_key:
-            await s3_cache.store_cached_image(
-                cache_key,
-                img_bytes,
-                metadata={"faces_detected": len(faces)}
-            )
+        # If cache hit, stream the cached result straight through
+        if cached:
+            print(f"Cache HIT: {cache_key}")
+            return cached_stream_response(cached[0], filename,
+                                          {"X-Cache-Status": "HIT"}, cache_key)
 
-        # Reset buffer for response
-        img_buffer.seek(0)
+        print(f"Cache MISS: {cache_key}")
 
-        return StreamingResponse(
-            img_buffer,
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"inline; filename=santa_{filename}",
-                "X-Faces-Detected": str(len(faces)),
-                "X-Cache-Status": "MISS"
-            }
+        img_bytes, faces_detected = await render_image_once(cache_key, contents, hat_scale)
+
+        await s3_cache.store_cached_image(
+            cache_key,
+            img_bytes,
+            metadata={"faces_detected": faces_detected}
         )
 
+        return image_response(img_bytes, filename, {
+            "X-Faces-Detected": str(faces_detected),
+            "X-Cache-Status": "MISS"
+        }, cache_key)
+
     except HTTPException:
         raise
     except Exception as e:
@@ -533,4 +593,16 @@ async def santa_hatify(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools shave per-request overhead vs the asyncio/h11
+    # defaults (both ship with uvicorn[standard]); one worker per core
+    # keeps cache-HIT traffic flowing while renders occupy the pool.
+    # Multi-worker mode needs the app as an import string.
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        backlog=2048
+    )
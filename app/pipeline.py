@@ -0,0 +1,170 @@
+"""CPU-bound image pipeline, run inside process pool workers."""
+import io
+
+import numpy as np
+from PIL import Image
+
+from app.config import Config
+
+# simplejpeg calls libjpeg-turbo directly on a raw buffer, skipping
+# Pillow's encoder shim; fall back to Pillow where the wheel is missing
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Have PIL reject decompression bombs during decode instead of allocating
+# for them; the app-level pixel limit is enforced separately with a 400
+Image.MAX_IMAGE_PIXELS = Config.MAX_IMAGE_PIXELS
+
+# Per-process singletons, created lazily on the first task so pool workers
+# only pay the MediaPipe model load once
+_face_detector = None
+_hat_processor = None
+
+
+class PipelineError(Exception):
+    """
+    Processing failure with an HTTP status code and detail message.
+
+    Raised inside pool workers instead of HTTPException so it pickles
+    cleanly across the process boundary; handlers translate it back.
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _get_face_detector():
+    """Return this process's FaceDetector, creating it on first use."""
+    global _face_detector
+    if _face_detector is None:
+        from app.face_detection import FaceDetector
+        _face_detector = FaceDetector()
+    return _face_detector
+
+
+def _get_hat_processor():
+    """Return this process's SantaHatProcessor, creating it on first use."""
+    global _hat_processor
+    if _hat_processor is None:
+        from app.image_processing import SantaHatProcessor
+        _hat_processor = SantaHatProcessor()
+    return _hat_processor
+
+
+def process_image_bytes(contents: bytes, hat_scale: float = 1.0) -> tuple[bytes, int]:
+    """
+    Decode an image, add Santa hats to all detected faces, encode as JPEG.
+
+    Args:
+        contents: Raw image bytes
+        hat_scale: Optional scale multiplier (default 1.0, uses metadata config)
+
+    Returns:
+        Tuple of (encoded JPEG bytes, number of faces detected)
+
+    Raises:
+        PipelineError: For validation failures (unsupported format,
+            oversized image, no faces detected)
+    """
+    # Pillow raises for images more than 2x MAX_IMAGE_PIXELS before
+    # allocating; translate that to the same 400 as the explicit pixel
+    # check below so the API's error contract holds either way
+    try:
+        image = Image.open(io.BytesIO(contents))
+    except Image.DecompressionBombError:
+        raise PipelineError(
+            400,
+            f"Image has too many pixels. Maximum: {Config.MAX_IMAGE_PIXELS}"
+        )
+
+    # Validate image format
+    if image.format not in Config.ALLOWED_PIL_FORMATS:
+        raise PipelineError(
+            400,
+            f"Unsupported image format: {image.format}. Allowed formats: {', '.join(Config.ALLOWED_PIL_FORMATS)}"
+        )
+
+    # Validate image dimensions
+    width, height = image.size
+    if width > Config.MAX_IMAGE_WIDTH or height > Config.MAX_IMAGE_HEIGHT:
+        raise PipelineError(
+            400,
+            f"Image dimensions too large. Maximum: {Config.MAX_IMAGE_WIDTH}x{Config.MAX_IMAGE_HEIGHT}px, got: {width}x{height}px"
+        )
+
+    # Validate total pixels
+    total_pixels = width * height
+    if total_pixels > Config.MAX_IMAGE_PIXELS:
+        raise PipelineError(
+            400,
+            f"Image has too many pixels. Maximum: {Config.MAX_IMAGE_PIXELS}, got: {total_pixels}"
+        )
+
+    # For JPEGs, decode at a reduced DCT scale (1/2, 1/4, 1/8) - nearly
+    # free in libjpeg compared to full decode followed by a resize. Also
+    # keep the source quantization tables so the re-encode can match the
+    # original compression characteristics instead of requantizing.
+    source_qtables = None
+    if image.format == 'JPEG':
+        source_qtables = getattr(image, 'quantization', None)
+        image.draft('RGB', (Config.MAX_IMAGE_WIDTH_PROCESS,
+                            Config.MAX_IMAGE_HEIGHT_PROCESS))
+
+    # Convert to RGB if necessary (handle grayscale, palette, etc.)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+
+    # Detect faces
+    faces = _get_face_detector().detect_faces(image)
+
+    if not faces:
+        raise PipelineError(
+            404,
+            "No faces detected in the image. Please upload an image with visible faces."
+        )
+
+    # Limit number of faces processed
+    if len(faces) > Config.MAX_FACES:
+        faces = faces[:Config.MAX_FACES]
+        print(f"Warning: Image has more than {Config.MAX_FACES} faces, limiting to {Config.MAX_FACES}")
+
+    # Process image with Santa hats
+    result_image = _get_hat_processor().process_image(image, faces, hat_scale)
+
+    # Convert back to RGB for JPEG output (remove alpha channel). The
+    # base photo is opaque, so a direct convert avoids a full-frame
+    # blend against a white background.
+    if result_image.mode == 'RGBA':
+        result_image = result_image.convert('RGB')
+
+    return _encode_jpeg(result_image, source_qtables), len(faces)
+
+
+def _encode_jpeg(image: Image.Image, qtables: dict = None) -> bytes:
+    """
+    Encode an RGB image as JPEG.
+
+    With source quantization tables the output reuses them via Pillow,
+    matching the original's compression (usually fewer bits than a fresh
+    quality setting); otherwise simplejpeg's TurboJPEG fast path is
+    preferred when available.
+    """
+    if qtables:
+        img_buffer = io.BytesIO()
+        image.save(img_buffer, format='JPEG', qtables=qtables)
+        return img_buffer.getvalue()
+
+    if simplejpeg is not None:
+        return simplejpeg.encode_jpeg(
+            np.ascontiguousarray(np.asarray(image)),
+            quality=Config.JPEG_QUALITY,
+            colorspace='RGB'
+        )
+
+    img_buffer = io.BytesIO()
+    image.save(img_buffer, format='JPEG', quality=Config.JPEG_QUALITY)
+    return img_buffer.getvalue()
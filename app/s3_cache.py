@@ -1,16 +1,70 @@
 """S3-based caching service for processed images."""
+import asyncio
+import base64
+import functools
 import hashlib
-import io
+import logging
 import os
+from collections import OrderedDict
 from typing import Optional, Tuple
 import boto3
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
-import httpx
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=32)
+def _scale_bytes(hat_scale: float) -> bytes:
+    """
+    Normalized hat_scale bytes for key hashing.
+
+    Fixed-point formatting keeps float-repr noise (0.1 + 0.2 vs 0.3) from
+    splitting semantically identical requests across cache keys, and the
+    memo avoids re-encoding the handful of scales seen in practice.
+    """
+    return f"{hat_scale:.6f}".encode()
+
+
+def _format_key(digest: bytes) -> str:
+    """
+    Format a key digest as an S3 object key.
+
+    Unpadded lowercase base32 packs the 16-byte digest into 26
+    characters instead of 32 hex ones - slightly less key material on
+    every request, log line, and list response - while staying safe for
+    S3 keys and case-insensitive filesystems. The two-character shard
+    prefix is kept for key-space distribution.
+    """
+    encoded = base64.b32encode(digest).rstrip(b'=').decode().lower()
+    return f"{encoded[:2]}/{encoded}-processed.jpg"
+
+
+class _MemoryBody:
+    """In-memory stand-in for a botocore StreamingBody."""
+
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+    def iter_chunks(self, chunk_size: int):
+        for start in range(0, len(self._data), chunk_size):
+            yield self._data[start:start + chunk_size]
 
 
 class S3Cache:
     """S3-based cache for storing and retrieving processed images."""
 
+    # Hot keys are served from an in-process LRU instead of paying the
+    # S3 round trip on every repeat request
+    MEMCACHE_MAX_BYTES = 64 * 1024 * 1024
+
+    # Keys recently confirmed absent skip the NoSuchKey round trip until
+    # a store clears them (bursty traffic on a cold key hits S3 once)
+    MISS_CACHE_SIZE = 10_000
+
     def __init__(self):
         """Initialize S3 client with configuration from environment variables."""
         self.enabled = False
@@ -18,32 +72,103 @@ class S3Cache:
         self.bucket_name = os.getenv("S3_BUCKET_NAME") or os.getenv("AWS_S3_BUCKET_NAME")
         self.region = os.getenv("AWS_REGION", "us-east-1")
 
+        # In-process LRU of (image bytes, metadata), bounded by total size
+        self._memcache: OrderedDict[str, Tuple[bytes, dict]] = OrderedDict()
+        self._memcache_bytes = 0
+
+        # Negative cache: LRU set of keys S3 recently answered NoSuchKey for
+        self._recent_misses: OrderedDict[str, None] = OrderedDict()
+
         # Check if S3 is configured
         if not self.bucket_name:
-            print("S3 caching disabled: S3_BUCKET_NAME not set")
+            logger.info("S3 caching disabled: S3_BUCKET_NAME not set")
             return
 
         try:
-            # Initialize S3 client (uses AWS credentials from environment)
+            # Initialize S3 client (uses AWS credentials from environment).
+            # The pool is sized for the thread offload above the default
+            # of 10; keepalive avoids TCP slow-start between requests and
+            # adaptive retries back off on 503 SlowDown.
             self.s3_client = boto3.client(
                 's3',
                 region_name=self.region,
                 aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                config=BotoConfig(
+                    max_pool_connections=50,
+                    tcp_keepalive=True,
+                    retries={'mode': 'adaptive', 'max_attempts': 3}
+                )
             )
 
-            # Verify bucket access
-            self.s3_client.head_bucket(Bucket=self.bucket_name)
+            # Bucket access is not probed here - that would cost an S3
+            # round trip per construction. A misconfigured bucket surfaces
+            # as errors on the first real get/put, which already log and
+            # degrade to cache misses.
             self.enabled = True
-            print(f"S3 caching enabled: bucket={self.bucket_name}, region={self.region}")
+            logger.info("S3 caching enabled: bucket=%s, region=%s", self.bucket_name, self.region)
 
-        except ClientError as e:
-            print(f"S3 caching disabled: Failed to initialize - {e}")
         except Exception as e:
-            print(f"S3 caching disabled: Unexpected error - {e}")
+            logger.error("S3 caching disabled: Unexpected error - %s", e)
+
+    def _memcache_get(self, cache_key: str) -> Optional[Tuple[bytes, dict]]:
+        """Look up a key in the in-process LRU, refreshing its recency."""
+        entry = self._memcache.get(cache_key)
+        if entry is not None:
+            self._memcache.move_to_end(cache_key)
+        return entry
+
+    def _memcache_put(self, cache_key: str, image_data: bytes, metadata: dict):
+        """Insert into the in-process LRU, evicting oldest entries by size."""
+        if len(image_data) > self.MEMCACHE_MAX_BYTES:
+            return
+        old = self._memcache.pop(cache_key, None)
+        if old is not None:
+            self._memcache_bytes -= len(old[0])
+        self._memcache[cache_key] = (image_data, metadata)
+        self._memcache_bytes += len(image_data)
+        while self._memcache_bytes > self.MEMCACHE_MAX_BYTES:
+            _, (evicted, _) = self._memcache.popitem(last=False)
+            self._memcache_bytes -= len(evicted)
+
+    def _note_miss(self, cache_key: str):
+        """Record a confirmed S3 miss, evicting the oldest beyond the cap."""
+        self._recent_misses[cache_key] = None
+        self._recent_misses.move_to_end(cache_key)
+        if len(self._recent_misses) > self.MISS_CACHE_SIZE:
+            self._recent_misses.popitem(last=False)
 
     @staticmethod
-    def generate_cache_key_from_hash(content: bytes, hat_scale: float = 1.0) -> str:
+    def content_hasher():
+        """
+        Return a hasher for incremental content-key hashing.
+
+        Callers that already read a body in chunks can feed each chunk
+        here and finalize with generate_cache_key_from_hasher, avoiding
+        a second full pass over the buffered bytes. BLAKE2b is
+        considerably faster than SHA-256 in software for multi-MB
+        uploads, and cache keys don't need a NIST digest. A 16-byte
+        digest is plenty for key uniqueness and halves the key length.
+        """
+        return hashlib.blake2b(digest_size=16)
+
+    @staticmethod
+    def generate_cache_key_from_hasher(hasher, hat_scale: float = 1.0) -> str:
+        """
+        Finalize an incremental content hasher into a cache key.
+
+        Args:
+            hasher: Hasher from content_hasher(), fed the full body
+            hat_scale: Hat scale parameter
+
+        Returns:
+            Cache key string
+        """
+        hasher.update(_scale_bytes(hat_scale))
+        return _format_key(hasher.digest())
+
+    @classmethod
+    def generate_cache_key_from_hash(cls, content: bytes, hat_scale: float = 1.0) -> str:
         """
         Generate a cache key from file content hash.
 
@@ -54,86 +179,122 @@ class S3Cache:
         Returns:
             Cache key string
         """
-        # Create hash of content + hat_scale
-        hasher = hashlib.sha256()
+        hasher = cls.content_hasher()
         hasher.update(content)
-        hasher.update(str(hat_scale).encode())
-        content_hash = hasher.hexdigest()
-
-        return f"processed/{content_hash[:2]}/{content_hash}.jpg"
+        return cls.generate_cache_key_from_hasher(hasher, hat_scale)
 
     @staticmethod
-    async def generate_cache_key_from_url(url: str, hat_scale: float = 1.0) -> Optional[str]:
+    @functools.lru_cache(maxsize=1024)
+    def generate_cache_key_from_url(url: str, hat_scale: float = 1.0) -> str:
         """
-        Generate a cache key from URL using ETag or Last-Modified headers.
-        Falls back to URL hash if headers unavailable.
+        Generate a cache key from the URL itself.
+
+        Freshness is handled by conditional GET revalidation against the
+        upstream validators stored with the cached object, so no extra
+        HEAD round-trip is needed here. The same URLs tend to be
+        requested repeatedly, so the (url, scale) -> key mapping is
+        memoized; the function is pure, so no TTL is needed.
 
         Args:
             url: Image URL
             hat_scale: Hat scale parameter
 
         Returns:
-            Cache key string or None if URL is unreachable
+            Cache key string
         """
-        try:
-            # Make HEAD request to get ETag/Last-Modified without downloading
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.head(url, follow_redirects=True)
-                response.raise_for_status()
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(url.encode())
+        hasher.update(_scale_bytes(hat_scale))
+        return _format_key(hasher.digest())
 
-                # Try to get ETag (most reliable for cache invalidation)
-                etag = response.headers.get("etag", "").strip('"')
-                last_modified = response.headers.get("last-modified", "")
+    async def get_cached_image(self, cache_key: str) -> Optional[bytes]:
+        """
+        Retrieve cached image from S3.
+
+        Args:
+            cache_key: S3 object key
 
-                # Create identifier from available headers
-                identifier = etag or last_modified or url
+        Returns:
+            Image bytes if found, None otherwise
+        """
+        if not self.enabled:
+            return None
 
-                # Hash the identifier + hat_scale
-                hasher = hashlib.sha256()
-                hasher.update(identifier.encode())
-                hasher.update(str(hat_scale).encode())
-                cache_hash = hasher.hexdigest()
+        entry = self._memcache_get(cache_key)
+        if entry is not None:
+            return entry[0]
 
-                return f"processed/{cache_hash[:2]}/{cache_hash}.jpg"
+        if cache_key in self._recent_misses:
+            return None
 
+        try:
+            response = await asyncio.to_thread(
+                self.s3_client.get_object,
+                Bucket=self.bucket_name,
+                Key=cache_key
+            )
+            return await asyncio.to_thread(response['Body'].read)
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                # Cache miss - this is normal; remember it so repeat
+                # lookups skip the round trip until a store lands
+                self._note_miss(cache_key)
+                return None
+            else:
+                logger.error("Error retrieving from S3 cache: %s", e)
+                return None
         except Exception as e:
-            print(f"Failed to generate cache key from URL headers: {e}")
-            # Fallback to URL hash
-            hasher = hashlib.sha256()
-            hasher.update(url.encode())
-            hasher.update(str(hat_scale).encode())
-            cache_hash = hasher.hexdigest()
-            return f"processed/{cache_hash[:2]}/{cache_hash}.jpg"
+            logger.error("Unexpected error retrieving from S3 cache: %s", e)
+            return None
 
-    async def get_cached_image(self, cache_key: str) -> Optional[bytes]:
+    async def open_cached_image(
+        self,
+        cache_key: str
+    ) -> Optional[Tuple[object, dict]]:
         """
-        Retrieve cached image from S3.
+        Open a cached image for streaming, without reading the body.
+
+        The returned body is a botocore StreamingBody; callers can
+        iterate it with iter_chunks() to pass S3's response straight
+        through to the client, or call read() when the bytes are needed
+        in memory.
 
         Args:
             cache_key: S3 object key
 
         Returns:
-            Image bytes if found, None otherwise
+            Tuple of (body stream, metadata dict) if found, None otherwise
         """
         if not self.enabled:
             return None
 
+        entry = self._memcache_get(cache_key)
+        if entry is not None:
+            return _MemoryBody(entry[0]), entry[1]
+
+        if cache_key in self._recent_misses:
+            return None
+
         try:
-            response = self.s3_client.get_object(
+            response = await asyncio.to_thread(
+                self.s3_client.get_object,
                 Bucket=self.bucket_name,
                 Key=cache_key
             )
-            return response['Body'].read()
+            return response['Body'], response.get('Metadata', {})
 
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
-                # Cache miss - this is normal
+                # Cache miss - this is normal; remember it so repeat
+                # lookups skip the round trip until a store lands
+                self._note_miss(cache_key)
                 return None
             else:
-                print(f"Error retrieving from S3 cache: {e}")
+                logger.error("Error retrieving from S3 cache: %s", e)
                 return None
         except Exception as e:
-            print(f"Unexpected error retrieving from S3 cache: {e}")
+            logger.error("Unexpected error retrieving from S3 cache: %s", e)
             return None
 
     async def store_cached_image(
@@ -157,24 +318,30 @@ class S3Cache:
             return False
 
         try:
-            # Prepare metadata
-            s3_metadata = metadata or {}
-            s3_metadata['ContentType'] = 'image/jpeg'
+            # Only caller-supplied metadata goes on the object; the
+            # content type is already the top-level put_object parameter
+            s3_metadata = {k: str(v) for k, v in metadata.items()} if metadata else {}
 
             # Upload to S3
-            self.s3_client.put_object(
+            await asyncio.to_thread(
+                self.s3_client.put_object,
                 Bucket=self.bucket_name,
                 Key=cache_key,
                 Body=image_data,
                 ContentType='image/jpeg',
-                Metadata={k: str(v) for k, v in s3_metadata.items()},
+                Metadata=s3_metadata,
                 # Set cache control for CDN
                 CacheControl='public, max-age=31536000'  # 1 year
             )
 
-            print(f"Cached image to S3: {cache_key}")
+            # Fresh renders are the likeliest next lookups, and the key
+            # is no longer a known miss
+            self._recent_misses.pop(cache_key, None)
+            self._memcache_put(cache_key, image_data, s3_metadata)
+
+            logger.debug("Cached image to S3: %s", cache_key)
             return True
 
         except Exception as e:
-            print(f"Error storing to S3 cache: {e}")
+            logger.error("Error storing to S3 cache: %s", e)
             return False